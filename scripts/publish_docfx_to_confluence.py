@@ -5,18 +5,57 @@ Script for publishing content from a generated DocFX web site to Confluence.
 """
 
 import argparse
+import datetime
+import itertools
 import json
 import lxml.etree as xml
 import lxml.html as html
+import mimetypes
 import os
+import posixpath
 import requests
 import urllib.parse as urlparse
 import yaml
+import zipfile
 
 DOCFX_LANGUAGE_MAP = {
     "csharp": "c#"
 }
 
+CONFLUENCE_PAGE_PACKAGE = "com.atlassian.confluence.pages"
+CONFLUENCE_CORE_PACKAGE = "com.atlassian.confluence.core"
+CONFLUENCE_CONTENT_PACKAGE = "com.atlassian.confluence.content"
+CONFLUENCE_SPACE_PACKAGE = "com.atlassian.confluence.spaces"
+CONFLUENCE_USER_PACKAGE = "com.atlassian.confluence.user"
+
+# Plugin module that stores JSON content properties (the ones created via the REST API) as custom content.
+CONTENT_PROPERTY_MODULE_KEY = "com.atlassian.confluence.plugins.confluence-content-property-storage:content-property"
+
+# Namespaces for the "ac" and "ri" prefixes in Confluence storage format.
+STORAGE_FORMAT_NAMESPACES = {
+    "ac": "http://atlassian.com/content",
+    "ri": "http://atlassian.com/resource/identifier"
+}
+
+CONFLUENCE_SECURITY_PACKAGE = "com.atlassian.confluence.security"
+
+# The space permissions granted to space administrators (users and groups that can view a space only get "VIEWSPACE").
+SPACE_ADMIN_PERMISSIONS = [
+    "VIEWSPACE", "EDITSPACE", "EXPORTPAGE", "SETPAGEPERMISSIONS", "REMOVEPAGE", "EDITBLOG", "REMOVEBLOG", "COMMENT",
+    "REMOVECOMMENT", "CREATEATTACHMENT", "REMOVEATTACHMENT", "REMOVEMAIL", "EXPORTSPACE", "SETSPACEPERMISSIONS"
+]
+
+# Entity collections that are not plain java.util.Collection.
+COLLECTION_CLASSES = {
+    "ancestors": "java.util.List",
+    "permissions": "java.util.Set"
+}
+
+# Entities whose Id is not named "id".
+ENTITY_ID_NAMES = {
+    "ConfluenceUserImpl": "key"
+}
+
 
 def main():
     """
@@ -25,14 +64,33 @@ def main():
 
     args = parse_args()
 
+    if args.verify_bundle:
+        verify_bundle(args.verify_bundle)
+
+        return
+
     manifest = load_docfx_manifest(args.docfx_manifest)
     base_directory = os.path.dirname(args.docfx_manifest)
     docfx_mappings = load_docfx_xref_map(
         filename=os.path.join(base_directory, manifest["xrefmap"])
     )
 
+    if args.export_bundle:
+        export_bundle(args.export_bundle, args.confluence_space, base_directory, docfx_mappings,
+            first_id=args.export_first_id,
+            build_number=args.confluence_build_number,
+            creator=(args.confluence_user, args.export_creator_key) if args.export_creator_key else None,
+            admin_group=args.export_admin_group,
+            view_group=args.export_view_group
+        )
+        verify_bundle(args.export_bundle)
+
+        return
+
     confluence_client = ConfluenceClient(args.confluence_address, args.confluence_user, args.confluence_password)
-    confluence_mappings = get_confluence_mappings(confluence_client, args.confluence_space)
+
+    untracked_pages = {}
+    confluence_mappings = get_confluence_mappings(confluence_client, args.confluence_space, untracked_pages)
 
     docfx_uid_to_confluence_id = {
         entry["docfx_uid"]: entry["confluence_id"] for entry in confluence_mappings
@@ -62,40 +120,37 @@ def main():
         ))
 
         for mapping in new_mappings:
-            mapping["title"] = "DocFX - {name} ({uid})".format(**mapping)
+            mapping["title"] = get_page_title(mapping)
             print("\t{href} (UID='{uid}') => '{title}'".format(**mapping))
 
-            confluence_id = confluence_client.create_page(
-                space_key=args.confluence_space,
-                title=mapping["title"],
-                content="<h1>Placeholder</h1>\nThis page is a placeholder.",
-                docfx_uid=mapping["uid"],
-                docfx_href=mapping["href"]
-            )
+            confluence_id = untracked_pages.get(mapping["title"])
+            if confluence_id is not None:
+                # The page already exists, but has lost (or never had) its DocFX properties; adopt it rather than creating a duplicate.
+                confluence_client.create_docfx_property(confluence_id, mapping["uid"], mapping["href"])
+                action = "Adopted"
+            else:
+                confluence_id = confluence_client.create_page(
+                    space_key=args.confluence_space,
+                    title=mapping["title"],
+                    content="<h1>Placeholder</h1>\nThis page is a placeholder.",
+                    docfx_uid=mapping["uid"],
+                    docfx_href=mapping["href"]
+                )
+                action = "Created"
+
             mapping["confluence_id"] = confluence_id
             docfx_uid_to_confluence_id[mapping["uid"]] = confluence_id
             docfx_href_to_confluence_id[mapping["href"]] = confluence_id
-            print("\tCreated:  {href} (UID='{uid}') => {confluence_id}".format(**mapping))
+            print("\t{action}:  {href} (UID='{uid}') => {confluence_id}".format(action=action, **mapping))
             mappings.append(mapping)
 
     # Now that we know all the page Ids, update content.
     for mapping in mappings:
-        mapping["title"] = "DocFX - {name} ({uid})".format(**mapping)
+        mapping["title"] = get_page_title(mapping)
         print("\t{href} (UID='{uid}') => '{title}'".format(**mapping))
 
-        page_href = mapping["href"]
-        _, _, page_path, _, _ = urlparse.urlsplit(page_href)
-
-        page_dir = os.path.dirname(page_path.lstrip("/"))
-        page_local_path = os.path.join(base_directory,
-            page_path.lstrip("/").replace("/", "\\")
-        )
-        with open(page_local_path) as page_content_file:
-            page_content = '\n'.join((
-                line.lstrip("\xef\xbb\xbf") for line in page_content_file.readlines()
-            ))
-
-            page_content = transform_content(page_dir, page_content, docfx_href_to_confluence_id)
+        page_dir, page_content = load_page_content(base_directory, mapping["href"])
+        page_content = transform_content(page_dir, page_content, docfx_href_to_confluence_id)
 
         print("Updating Confluence page {}...".format(mapping["confluence_id"]))
         confluence_client.update_page(
@@ -108,18 +163,26 @@ def main():
         print("Updated: {href} (UID='{uid}') => {confluence_id}".format(**mapping))
 
 
-def transform_content(base_dir, content, mappings):
+def transform_content(base_dir, content, mappings, link_by_title=False, site_directory=None, attachments=None):
     """
     Transform markup and links in HTML content for compatibility with Confluence.
 
     :param base_dir: The base directory for the content (all links are evaluated relative to this). The root is "", not "/".
     :param content: The HTML content.
-    :param mappings: Mappings from link path (relative to root) to Confluence Id.
+    :param mappings: Mappings from link path (relative to root) to Confluence Id (or page title, if link_by_title is True).
+    :param link_by_title: If True, links are transformed into Confluence page links that refer to the target page by title.
+    :param site_directory: The local file-system path of the generated DocFX web site (required if attachments is specified).
+    :param attachments: An optional dictionary that receives mappings from attachment file name to image path (relative to root).
+        If specified, local images that exist in the site are transformed into references to page attachments
+        (and remote images into references to their URLs).
     :returns: The content, with links transformed.
 
     :type base_dir: str
     :type content: str
     :type mappings: dict
+    :type link_by_title: bool
+    :type site_directory: str
+    :type attachments: dict
     :rtype: str
     """
 
@@ -132,18 +195,78 @@ def transform_content(base_dir, content, mappings):
         if href is None:
             continue
 
-        _, _, path, _, _, _ = urlparse.urlparse(href)
+        scheme, netloc, path, _, _, fragment = urlparse.urlparse(href)
+        if scheme or netloc:
+            continue  # External link; leave it alone.
 
         # Remember - we'll be relative to some base directory.
-        relative_path = base_dir + "/" + path.lstrip("/")
+        relative_path = resolve_site_path(base_dir, path)
 
-        page_id = mappings.get(relative_path)
-        if page_id is None:
-            print("WARNING - no mapping for xref link '{}'.".format(relative_path))
+        target = mappings.get(relative_path)
+        if target is None:
+            print("WARNING - no mapping for xref link '{}'.".format(relative_path or href))
 
             continue
 
-        anchor.attrib["href"] = href.replace(path, "/pages/viewpage.action?pageId={}".format(page_id))
+        if not link_by_title:
+            anchor.attrib["href"] = href.replace(path, "/pages/viewpage.action?pageId={}".format(target))
+
+            continue
+
+        page_link = xml.Element("{urn:ac}link", nsmap={"ac": "urn:ac", "ri": "urn:ri"})
+        if fragment:
+            page_link.attrib["{urn:ac}anchor"] = fragment
+        xml.SubElement(page_link, "{urn:ri}page", {"{urn:ri}content-title": target})
+        link_body = xml.SubElement(page_link, "{urn:ac}link-body")
+        link_body.text = anchor.text
+        for child in list(anchor):
+            link_body.append(child)
+        page_link.tail = anchor.tail
+
+        # Replace anchor with our page link.
+        anchor.getparent().replace(anchor, page_link)
+
+    # Images
+    if attachments is not None:
+        images = content_html.cssselect("img")
+        for image in images:
+            src = image.attrib.get("src")
+            if not src:
+                continue
+
+            scheme, netloc, path, _, _, _ = urlparse.urlparse(src)
+            if scheme or netloc:
+                if scheme not in ("http", "https"):
+                    continue  # Not a remote image (e.g. a "data:" URI); leave it alone.
+
+                # Remote image; reference it by URL.
+                image_macro = xml.Element("{urn:ac}image", nsmap={"ac": "urn:ac", "ri": "urn:ri"})
+                xml.SubElement(image_macro, "{urn:ri}url", {"{urn:ri}value": src})
+                image_macro.tail = image.tail
+                image.getparent().replace(image, image_macro)
+
+                continue
+
+            image_path = resolve_site_path(base_dir, path)
+            if image_path is None:
+                print("WARNING - image '{}' is not a file in the site (it will not be attached).".format(src))
+
+                continue
+
+            if not os.path.isfile(os.path.join(site_directory, *image_path.split("/"))):
+                print("WARNING - image '{}' not found (it will not be attached).".format(image_path))
+
+                continue
+
+            attachment_filename = get_attachment_filename(image_path, attachments)
+            attachments[attachment_filename] = image_path
+
+            image_macro = xml.Element("{urn:ac}image", nsmap={"ac": "urn:ac", "ri": "urn:ri"})
+            xml.SubElement(image_macro, "{urn:ri}attachment", {"{urn:ri}filename": attachment_filename})
+            image_macro.tail = image.tail
+
+            # Replace image with our image macro.
+            image.getparent().replace(image, image_macro)
 
     # Code blocks
     xml_parser = xml.XMLParser(strip_cdata=False)
@@ -182,7 +305,7 @@ def transform_content(base_dir, content, mappings):
         # Replace contents with our code macro.
         code_wrapper_block.getparent().replace(code_wrapper_block, code_macro)
 
-    # Aaaand.. back to a regular string (since that's what we need to encode it in JSON).
+    # Aaaand.. back to a regular (XHTML) string (since that's what we need to encode it in JSON).
     transformed_content_html = b"\n".join((
         render_element(element) for element in content_html.getchildren()
     ))
@@ -190,41 +313,126 @@ def transform_content(base_dir, content, mappings):
     return transformed_content_html.decode()
 
 
+def get_attachment_filename(image_path, attachments):
+    """
+    Get a unique attachment file name for an image on a page.
+
+    Images with the same file name (from different directories) are given a numeric suffix ("logo-2.png").
+
+    :param image_path: The image path (relative to root).
+    :param attachments: Mappings from attachment file name to image path (relative to root) for the page's existing attachments.
+    :returns: The attachment file name.
+
+    :type image_path: str
+    :type attachments: dict
+    :rtype: str
+    """
+
+    attachment_filename = posixpath.basename(image_path)
+    name, extension = posixpath.splitext(attachment_filename)
+
+    suffix = 1
+    while attachments.get(attachment_filename, image_path) != image_path:
+        suffix += 1
+        attachment_filename = "{}-{}{}".format(name, suffix, extension)
+
+    return attachment_filename
+
+
+def resolve_site_path(base_dir, path):
+    """
+    Resolve a link path (relative to a page's directory, or to the site root if it starts with "/") to a path relative to the site root.
+
+    :param base_dir: The base directory for the link. The root is "", not "/".
+    :param path: The (URL-encoded) link path.
+    :returns: The resolved path, or None if the path does not refer to a file or lies outside the site.
+
+    :type base_dir: str
+    :type path: str
+    :rtype: str
+    """
+
+    path = urlparse.unquote(path)
+    if posixpath.basename(path) in ("", ".", ".."):
+        return None
+
+    if path.startswith("/"):
+        site_path = posixpath.normpath(path.lstrip("/"))
+    else:
+        site_path = posixpath.normpath(posixpath.join(base_dir, path))
+
+    if site_path == ".." or site_path.startswith("../"):
+        return None
+
+    return site_path
+
+
 def render_element(element):
     """
     Render a transformed HTML element as a string.
 
+    Elements are rendered as XML, since Confluence storage format is XHTML (void elements such as <img> must be closed).
+
     :param element: The HTML element.
     :returns: The rendered element.
     :rtype: bytes
     """
 
-    rendered = html.tostring(element)
+    rendered = xml.tostring(element, method="xml")
 
     # Remove temporary namespace; we had to be sneaky to get the "ac" prefix to stick.
     rendered = rendered.replace(b'xmlns:ac="urn:ac"', b'')
-
-    # And since this is HTML, we also have to be sneaky when it comes to rendering CDATA elements.
-    rendered = rendered.replace(b'<ac:plain-text-body>', b'<ac:plain-text-body><![CDATA[')
-    rendered = rendered.replace(b'</ac:plain-text-body>', b']]></ac:plain-text-body>')
+    rendered = rendered.replace(b'xmlns:ri="urn:ri"', b'')
 
     return rendered
 
 
-def get_confluence_mappings(confluence_client, space_key):
+def get_confluence_mappings(confluence_client, space_key, untracked_pages=None):
     """
     Retrieve existing page mappings from a Confluence space.
 
     :param confluence_client: The Confluence REST API client.
     :param space_key: The short name of the target Confluence space.
+    :param untracked_pages: An optional dictionary that receives mappings from page title to Confluence Id for pages that do not have DocFX properties.
     :returns: A list of mappings (confluence_id, docfx_uid, docfx_href).
     :type confluence_client: ConfluenceClient
     :type space_key: str
+    :type untracked_pages: dict
     :rtype: list
     """
 
     mappings = []
 
+    for result in get_confluence_pages(confluence_client, space_key):
+        properties = result["metadata"]["properties"]
+        if "docfx" not in properties:
+            if untracked_pages is not None:
+                untracked_pages[result["title"]] = result["id"]
+
+            continue  # Page does not have DocFX properties.
+
+        docfx_properties = properties["docfx"]["value"]["content"]
+
+        mappings.append({
+            "confluence_id": result["id"],
+            "docfx_uid": docfx_properties["docfx_uid"],
+            "docfx_href": docfx_properties["docfx_href"]
+        })
+
+    return mappings
+
+
+def get_confluence_pages(confluence_client, space_key):
+    """
+    Retrieve the pages (with their DocFX properties, if any) in a Confluence space.
+
+    :param confluence_client: The Confluence REST API client.
+    :param space_key: The short name of the target Confluence space.
+    :returns: A generator that yields each page.
+    :type confluence_client: ConfluenceClient
+    :type space_key: str
+    """
+
     step = 50
     uri_template = "space/{space_key}/content?type=page&expand=metadata.properties.docfx&start={start}&limit={limit}"
 
@@ -241,21 +449,607 @@ def get_confluence_mappings(confluence_client, space_key):
             break  # No more records.
 
         for result in results["results"]:
-            properties = result["metadata"]["properties"]
-            if "docfx" not in properties:
-                continue  # Page does not have DocFX properties.
+            yield result
+
+        offset += step
+
+
+def get_page_title(mapping):
+    """
+    Get the Confluence page title for a DocFX page.
+
+    :param mapping: The DocFX cross-reference map entry for the page.
+    :returns: The page title.
+    :type mapping: dict
+    :rtype: str
+    """
+
+    return "DocFX - {name} ({uid})".format(**mapping)
+
+
+def export_bundle(filename, space_key, base_directory, docfx_mappings, first_id, build_number, creator=None,
+                  admin_group="confluence-administrators", view_group="confluence-users"):
+    """
+    Write the DocFX web site to a Confluence space export bundle (instead of publishing it via the REST API).
+
+    Page Ids are assigned locally, so page content (including links) only has to be transformed once.
+    Entities and attachments are streamed to the bundle one page at a time.
+
+    :param filename: The local file-system path of the bundle (zip) file to create.
+    :param space_key: The key (short name) of the target space in Confluence.
+    :param base_directory: The local file-system path of the generated DocFX web site.
+    :param docfx_mappings: The entries from the DocFX cross-reference map.
+    :param first_id: The first Id to assign to entities in the bundle.
+    :param build_number: The build number of the target Confluence server.
+    :param creator: An optional (user name, user key) tuple identifying the Confluence user recorded as the creator of the content.
+        The creator is also made a space administrator.
+    :param admin_group: The name of the Confluence group whose members administer the space (None for no group).
+    :param view_group: The name of the Confluence group whose members can view the space (None for no group).
+
+    :type filename: str
+    :type space_key: str
+    :type base_directory: str
+    :type docfx_mappings: list
+    :type first_id: int
+    :type build_number: str
+    :type creator: tuple
+    :type admin_group: str
+    :type view_group: str
+    """
+
+    entity_ids = itertools.count(first_id)
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.000")
+
+    space_id = next(entity_ids)
+    space_description_id = next(entity_ids)
+    space_description_body_id = next(entity_ids)
+
+    # Space permissions, as (Id, permission type, group name, user key) tuples.
+    space_permissions = []
+    if admin_group:
+        space_permissions += [
+            (next(entity_ids), permission_type, admin_group, None) for permission_type in SPACE_ADMIN_PERMISSIONS
+        ]
+    if creator is not None:
+        space_permissions += [
+            (next(entity_ids), permission_type, None, creator[1]) for permission_type in SPACE_ADMIN_PERMISSIONS
+        ]
+    if view_group:
+        space_permissions.append((next(entity_ids), "VIEWSPACE", view_group, None))
+
+    # Creator / last modifier of every content entity in the bundle (if known).
+    auditing_properties = [
+        ("creationDate", timestamp),
+        ("lastModificationDate", timestamp)
+    ]
+    if creator is not None:
+        auditing_properties += [
+            ("creator", ("ConfluenceUserImpl", CONFLUENCE_USER_PACKAGE, creator[1])),
+            ("lastModifier", ("ConfluenceUserImpl", CONFLUENCE_USER_PACKAGE, creator[1]))
+        ]
+
+    # Assign page Ids and titles up-front so that links can be transformed in a single pass.
+    # Links refer to pages by title, since Confluence may assign new Ids when importing the bundle.
+    page_path_to_confluence_id = {}
+    page_path_to_title = {}
+    for mapping in docfx_mappings:
+        mapping["title"] = get_page_title(mapping)
+        mapping["confluence_id"] = next(entity_ids)
+
+        _, _, page_path, _, _ = urlparse.urlsplit(mapping["href"])
+        page_path = resolve_site_path("", page_path)
+        page_path_to_confluence_id.setdefault(page_path, mapping["confluence_id"])
+        page_path_to_title.setdefault(page_path, mapping["title"])
+
+    home_page_id = page_path_to_confluence_id.get("index.html")
+
+    # Work out the page hierarchy up-front, too (a page's entity lists both its ancestors and its children).
+    page_id_to_parent_id = {}
+    page_id_to_child_ids = {}
+    for mapping in docfx_mappings:
+        parent_id = get_parent_page_id(mapping["href"], page_path_to_confluence_id)
+        if parent_id is None or parent_id == mapping["confluence_id"]:
+            continue
+
+        page_id_to_parent_id[mapping["confluence_id"]] = parent_id
+        page_id_to_child_ids.setdefault(parent_id, []).append(mapping["confluence_id"])
+
+    print("Writing {} pages to export bundle '{}'...".format(len(docfx_mappings), filename))
+
+    bundle_attachments = []
+    with zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as bundle:
+        with bundle.open("entities.xml", "w", force_zip64=True) as entities_stream:
+            with xml.xmlfile(entities_stream, encoding="UTF-8") as entities_file:
+                entities_file.write_declaration()
+                with entities_file.element("hibernate-generic", datetime=timestamp):
+                    if creator is not None:
+                        creator_name, creator_key = creator
+                        write_entity(entities_file, "ConfluenceUserImpl", CONFLUENCE_USER_PACKAGE, creator_key, [
+                            ("name", creator_name),
+                            ("lowerName", creator_name.lower())
+                        ])
+
+                    space_properties = [
+                        ("name", "DocFX"),
+                        ("key", space_key),
+                        ("lowerKey", space_key.lower()),
+                        ("description", ("SpaceDescription", CONFLUENCE_SPACE_PACKAGE, space_description_id)),
+                        ("spaceType", "global"),
+                        ("spaceStatus", "CURRENT")
+                    ] + auditing_properties
+                    if home_page_id is not None:
+                        space_properties.append(
+                            ("homePage", ("Page", CONFLUENCE_PAGE_PACKAGE, home_page_id))
+                        )
+                    if space_permissions:
+                        space_properties.append(("permissions", [
+                            ("SpacePermission", CONFLUENCE_SECURITY_PACKAGE, permission_id)
+                            for permission_id, _, _, _ in space_permissions
+                        ]))
+                    write_entity(entities_file, "Space", CONFLUENCE_SPACE_PACKAGE, space_id, space_properties)
+
+                    for permission_id, permission_type, group_name, user_key in space_permissions:
+                        permission_properties = [
+                            ("space", ("Space", CONFLUENCE_SPACE_PACKAGE, space_id)),
+                            ("type", permission_type)
+                        ]
+                        if group_name:
+                            permission_properties.append(("group", group_name))
+                        if user_key:
+                            permission_properties.append(
+                                ("userSubject", ("ConfluenceUserImpl", CONFLUENCE_USER_PACKAGE, user_key))
+                            )
+                        write_entity(entities_file, "SpacePermission", CONFLUENCE_SECURITY_PACKAGE, permission_id,
+                            permission_properties + auditing_properties
+                        )
+
+                    write_entity(entities_file, "SpaceDescription", CONFLUENCE_SPACE_PACKAGE, space_description_id, [
+                        ("space", ("Space", CONFLUENCE_SPACE_PACKAGE, space_id)),
+                        ("bodyContents", [("BodyContent", CONFLUENCE_CORE_PACKAGE, space_description_body_id)]),
+                        ("version", 1),
+                        ("contentStatus", "current")
+                    ] + auditing_properties)
+                    write_entity(entities_file, "BodyContent", CONFLUENCE_CORE_PACKAGE, space_description_body_id, [
+                        ("body", "Content imported from a generated DocFX web site."),
+                        ("content", ("SpaceDescription", CONFLUENCE_SPACE_PACKAGE, space_description_id)),
+                        ("bodyType", 2)  # Storage format
+                    ])
+
+                    for mapping in docfx_mappings:
+                        page_id = mapping["confluence_id"]
+                        print("\t{href} (UID='{uid}') => {confluence_id}".format(**mapping))
+
+                        page_dir, page_content = load_page_content(base_directory, mapping["href"])
+                        page_attachments = {}
+                        page_content = transform_content(page_dir, page_content, page_path_to_title,
+                            link_by_title=True,
+                            site_directory=base_directory,
+                            attachments=page_attachments
+                        )
+
+                        body_id = next(entity_ids)
+                        page_properties = [
+                            ("title", mapping["title"]),
+                            ("lowerTitle", mapping["title"].lower()),
+                            ("space", ("Space", CONFLUENCE_SPACE_PACKAGE, space_id)),
+                            ("bodyContents", [("BodyContent", CONFLUENCE_CORE_PACKAGE, body_id)]),
+                            ("version", 1),
+                            ("contentStatus", "current")
+                        ] + auditing_properties
+                        parent_id = page_id_to_parent_id.get(page_id)
+                        if parent_id is not None:
+                            page_properties.append(
+                                ("parent", ("Page", CONFLUENCE_PAGE_PACKAGE, parent_id))
+                            )
+
+                            ancestor_ids = []
+                            while parent_id is not None:
+                                ancestor_ids.insert(0, parent_id)
+                                parent_id = page_id_to_parent_id.get(parent_id)
+                            page_properties.append(("ancestors", [
+                                ("Page", CONFLUENCE_PAGE_PACKAGE, ancestor_id) for ancestor_id in ancestor_ids
+                            ]))
+
+                        child_ids = page_id_to_child_ids.get(page_id)
+                        if child_ids:
+                            page_properties.append(("children", [
+                                ("Page", CONFLUENCE_PAGE_PACKAGE, child_id) for child_id in child_ids
+                            ]))
+                        write_entity(entities_file, "Page", CONFLUENCE_PAGE_PACKAGE, page_id, page_properties)
+
+                        write_entity(entities_file, "BodyContent", CONFLUENCE_CORE_PACKAGE, body_id, [
+                            ("body", page_content),
+                            ("content", ("Page", CONFLUENCE_PAGE_PACKAGE, page_id)),
+                            ("bodyType", 2)  # Storage format
+                        ])
+
+                        # DocFX metadata, as the JSON content property that the REST API client attaches to the page.
+                        property_id = next(entity_ids)
+                        property_body_id = next(entity_ids)
+                        write_entity(entities_file, "CustomContentEntityObject", CONFLUENCE_CONTENT_PACKAGE, property_id, [
+                            ("title", "docfx"),
+                            ("lowerTitle", "docfx"),
+                            ("pluginModuleKey", CONTENT_PROPERTY_MODULE_KEY),
+                            ("containerContent", ("Page", CONFLUENCE_PAGE_PACKAGE, page_id)),
+                            ("bodyContents", [("BodyContent", CONFLUENCE_CORE_PACKAGE, property_body_id)]),
+                            ("version", 1),
+                            ("contentStatus", "current")
+                        ] + auditing_properties)
+                        write_entity(entities_file, "BodyContent", CONFLUENCE_CORE_PACKAGE, property_body_id, [
+                            ("body", json.dumps({
+                                "description": "DocFX page properties",
+                                "content": {
+                                    "docfx_uid": mapping["uid"],
+                                    "docfx_href": mapping["href"]
+                                }
+                            })),
+                            ("content", ("CustomContentEntityObject", CONFLUENCE_CONTENT_PACKAGE, property_id)),
+                            ("bodyType", 0)  # Raw (JSON)
+                        ])
+
+                        for attachment_filename, image_path in sorted(page_attachments.items()):
+                            image_local_path = os.path.join(base_directory, *image_path.split("/"))
+                            attachment_id = next(entity_ids)
+                            write_entity(entities_file, "Attachment", CONFLUENCE_PAGE_PACKAGE, attachment_id, [
+                                ("title", attachment_filename),
+                                ("version", 1),
+                                ("contentStatus", "current"),
+                                ("containerContent", ("Page", CONFLUENCE_PAGE_PACKAGE, page_id))
+                            ] + auditing_properties)
+                            write_entity(entities_file, "ContentProperty", CONFLUENCE_CONTENT_PACKAGE, next(entity_ids), [
+                                ("name", "FILESIZE"),
+                                ("longValue", os.path.getsize(image_local_path)),
+                                ("content", ("Attachment", CONFLUENCE_PAGE_PACKAGE, attachment_id))
+                            ])
+                            write_entity(entities_file, "ContentProperty", CONFLUENCE_CONTENT_PACKAGE, next(entity_ids), [
+                                ("name", "MEDIA_TYPE"),
+                                ("stringValue", mimetypes.guess_type(attachment_filename)[0] or "application/octet-stream"),
+                                ("content", ("Attachment", CONFLUENCE_PAGE_PACKAGE, attachment_id))
+                            ])
+
+                            bundle_attachments.append((
+                                "attachments/{}/{}/1".format(page_id, attachment_id),
+                                image_local_path
+                            ))
+
+                        entities_file.flush()
+
+        # Only one member of a zip file can be open for writing at a time, so attachment data comes after the entities.
+        for attachment_name, attachment_local_path in bundle_attachments:
+            bundle.write(attachment_local_path, attachment_name)
+
+        bundle.writestr("exportDescriptor.properties", "\n".join((
+            "exportType=space",
+            "spaceKey={}".format(space_key),
+            "backupAttachments=true",
+            "source=server",
+            "buildNumber={}".format(build_number),
+            "createdByBuildNumber={}".format(build_number),
+            ""
+        )))
+
+    print("Wrote {} pages and {} attachments to export bundle '{}'.".format(
+        len(docfx_mappings), len(bundle_attachments), filename
+    ))
+
+
+def get_parent_page_id(page_href, page_path_to_confluence_id):
+    """
+    Determine the parent of a page, based on the page's location in the generated DocFX web site.
+
+    A page's parent is the closest "index.html" page in the page's directory (or its ancestors).
+
+    :param page_href: The page's URL in the generated DocFX web site.
+    :param page_path_to_confluence_id: Mappings from page path (relative to root) to Confluence Id.
+    :returns: The Confluence Id of the parent page, or None if the page is a top-level page.
+
+    :type page_href: str
+    :type page_path_to_confluence_id: dict
+    :rtype: int
+    """
+
+    _, _, page_path, _, _ = urlparse.urlsplit(page_href)
+    page_path = resolve_site_path("", page_path) or ""
+
+    page_dir = posixpath.dirname(page_path)
+    if posixpath.basename(page_path) == "index.html":
+        if not page_dir:
+            return None  # Root page.
+
+        page_dir = posixpath.dirname(page_dir)
+
+    while True:
+        parent_id = page_path_to_confluence_id.get(posixpath.join(page_dir, "index.html"))
+        if parent_id is not None:
+            return parent_id
+
+        if not page_dir:
+            return None
 
-            docfx_properties = properties["docfx"]["value"]["content"]
+        page_dir = posixpath.dirname(page_dir)
 
-            mappings.append({
-                "confluence_id": result["id"],
-                "docfx_uid": docfx_properties["docfx_uid"],
-                "docfx_href": docfx_properties["docfx_href"]
+
+def write_entity(entities_file, class_name, package, entity_id, properties):
+    """
+    Write an entity to the entities.xml file in a Confluence export bundle.
+
+    :param entities_file: The incremental XML writer for the entities.xml file.
+    :param class_name: The entity's class name.
+    :param package: The entity's package name.
+    :param entity_id: The entity Id.
+    :param properties: A list of (name, value) tuples representing the entity's properties.
+        A value can be a simple value, a reference to another entity (class_name, package, entity_id),
+        or a list of references to other entities.
+    """
+
+    entity = xml.Element("object", {"class": class_name, "package": package})
+    xml.SubElement(entity, "id", name=ENTITY_ID_NAMES.get(class_name, "id")).text = str(entity_id)
+
+    for property_name, property_value in properties:
+        if isinstance(property_value, list):
+            collection = xml.SubElement(entity, "collection", {
+                "name": property_name, "class": COLLECTION_CLASSES.get(property_name, "java.util.Collection")
+            })
+            for element_class_name, element_package, element_id in property_value:
+                element = xml.SubElement(collection, "element", {"class": element_class_name, "package": element_package})
+                xml.SubElement(element, "id", name=ENTITY_ID_NAMES.get(element_class_name, "id")).text = str(element_id)
+        elif isinstance(property_value, tuple):
+            reference_class_name, reference_package, reference_id = property_value
+            reference = xml.SubElement(entity, "property", {
+                "name": property_name, "class": reference_class_name, "package": reference_package
             })
+            xml.SubElement(reference, "id", name=ENTITY_ID_NAMES.get(reference_class_name, "id")).text = str(reference_id)
+        else:
+            xml.SubElement(entity, "property", name=property_name).text = str(property_value)
 
-        offset += step
+    entities_file.write(entity)
 
-    return mappings
+
+def verify_bundle(filename):
+    """
+    Verify the integrity of a Confluence space export bundle, without connecting to Confluence.
+
+    :param filename: The local file-system path of the bundle (zip) file.
+    :type filename: str
+    """
+
+    print("Verifying export bundle '{}'...".format(filename))
+
+    problems = find_bundle_problems(filename)
+    if problems:
+        for problem in problems:
+            print("ERROR - {}".format(problem))
+
+        raise Exception("Export bundle '{}' failed verification ({} problems).".format(filename, len(problems)))
+
+    print("Verified export bundle '{}'.".format(filename))
+
+
+def find_bundle_problems(filename):
+    """
+    Find problems with a Confluence space export bundle.
+
+    Checks that the bundle has an export descriptor, that every entity reference and page link resolves to an entity
+    in the bundle, that no xref links were left unresolved, that page titles are unique, that parent and child pages agree,
+    that the space has an administrator, that every page has a docfx content property, and that the data for every
+    attachment is present.
+
+    :param filename: The local file-system path of the bundle (zip) file.
+    :returns: A list of problem descriptions (empty if the bundle is valid).
+    :type filename: str
+    :rtype: list
+    """
+
+    problems = []
+
+    entity_classes = {}
+    references = []
+    page_ids = []
+    page_parents = {}
+    page_children = set()
+    space_administered = False
+    page_titles = set()
+    docfx_property_pages = set()
+    page_links = []
+    attachment_titles = set()
+    attachment_links = []
+    attachment_data = []
+
+    try:
+        with zipfile.ZipFile(filename) as bundle:
+            bundle_names = set(bundle.namelist())
+
+            if "exportDescriptor.properties" not in bundle_names:
+                problems.append("Bundle does not contain exportDescriptor.properties.")
+            else:
+                export_descriptor = dict(
+                    line.split("=", 1) for line in bundle.read("exportDescriptor.properties").decode("utf-8").splitlines()
+                    if "=" in line and not line.startswith("#")
+                )
+                if export_descriptor.get("exportType") != "space":
+                    problems.append("Export descriptor does not describe a space export.")
+                for descriptor_key in ("spaceKey", "buildNumber"):
+                    if not export_descriptor.get(descriptor_key):
+                        problems.append("Export descriptor does not specify {}.".format(descriptor_key))
+
+            if "entities.xml" not in bundle_names:
+                problems.append("Bundle does not contain entities.xml.")
+
+                return problems
+
+            with bundle.open("entities.xml") as entities_stream:
+                try:
+                    for _, entity in xml.iterparse(entities_stream, tag="object", huge_tree=True):
+                        entity_class = entity.attrib.get("class")
+                        entity_id = read_entity_id(entity)
+                        if entity_id is None:
+                            problems.append("{} entity has a missing or invalid Id.".format(entity_class))
+                        elif entity_id in entity_classes:
+                            problems.append("Duplicate entity Id {}.".format(entity_id))
+                        else:
+                            entity_classes[entity_id] = entity_class
+
+                        for reference in itertools.chain(entity.iterfind("property[@class]"), entity.iterfind("collection/element")):
+                            reference_id = read_entity_id(reference)
+                            if reference_id is None:
+                                problems.append("{} {} has a reference with a missing or invalid Id.".format(entity_class, entity_id))
+                            else:
+                                references.append((entity_id, reference.attrib["class"], reference_id))
+
+                        if entity_id is None:
+                            pass  # Already reported above.
+                        elif entity_class == "Page":
+                            page_title = entity.findtext("property[@name='title']")
+                            page_ids.append(entity_id)
+                            parent_id = read_entity_id(entity.find("property[@name='parent']"))
+                            if parent_id is not None:
+                                page_parents[entity_id] = parent_id
+                            for child in entity.iterfind("collection[@name='children']/element"):
+                                page_children.add((entity_id, read_entity_id(child)))
+                            if not page_title:
+                                problems.append("Page {} has no title.".format(entity_id))
+                            elif page_title.lower() in page_titles:
+                                problems.append("Duplicate page title '{}' (page {}).".format(page_title, entity_id))
+                            else:
+                                page_titles.add(page_title.lower())
+                        elif entity_class == "SpacePermission":
+                            if entity.findtext("property[@name='type']") == "SETSPACEPERMISSIONS":
+                                space_administered = True
+                        elif entity_class == "CustomContentEntityObject":
+                            if entity.findtext("property[@name='pluginModuleKey']") == CONTENT_PROPERTY_MODULE_KEY:
+                                page_id = read_entity_id(entity.find("property[@name='containerContent']"))
+                                if page_id is None:
+                                    problems.append("Content property {} does not belong to any content.".format(entity_id))
+                                elif entity.findtext("property[@name='title']") == "docfx":
+                                    docfx_property_pages.add(page_id)
+                        elif entity_class == "BodyContent":
+                            content_reference = entity.find("property[@name='content']")
+                            page_id = read_entity_id(content_reference)
+                            if page_id is None:
+                                problems.append("BodyContent {} does not belong to any content.".format(entity_id))
+                            elif content_reference.attrib.get("class") == "CustomContentEntityObject":
+                                try:
+                                    json.loads(entity.findtext("property[@name='body']") or "")
+                                except ValueError as value_error:
+                                    problems.append("Body of custom content {} is not valid JSON: {}".format(page_id, value_error))
+                            else:
+                                body = entity.findtext("property[@name='body']") or ""
+                                try:
+                                    body_xml = parse_storage_format(body)
+                                except xml.XMLSyntaxError as syntax_error:
+                                    problems.append("Body of page {} is not well-formed storage format: {}".format(
+                                        page_id, syntax_error
+                                    ))
+                                else:
+                                    for page_link in body_xml.iterfind(".//ri:page", STORAGE_FORMAT_NAMESPACES):
+                                        page_links.append((page_id, page_link.attrib.get(
+                                            "{%s}content-title" % STORAGE_FORMAT_NAMESPACES["ri"]
+                                        )))
+                                    for attachment_link in body_xml.iterfind(".//ri:attachment", STORAGE_FORMAT_NAMESPACES):
+                                        attachment_links.append((page_id, attachment_link.attrib.get(
+                                            "{%s}filename" % STORAGE_FORMAT_NAMESPACES["ri"]
+                                        )))
+                                    for anchor in body_xml.xpath(".//a[contains(concat(' ', @class, ' '), ' xref ')]"):
+                                        scheme, netloc, _, _, _, _ = urlparse.urlparse(anchor.attrib.get("href", ""))
+                                        if not (scheme or netloc):
+                                            problems.append("Page {} has unresolved xref link '{}'.".format(
+                                                page_id, anchor.attrib.get("href")
+                                            ))
+                        elif entity_class == "Attachment":
+                            page_id = read_entity_id(entity.find("property[@name='containerContent']"))
+                            if page_id is None:
+                                problems.append("Attachment {} does not belong to any content.".format(entity_id))
+                            else:
+                                attachment_titles.add((page_id, entity.findtext("property[@name='title']")))
+                                attachment_data.append("attachments/{}/{}/{}".format(
+                                    page_id, entity_id, entity.findtext("property[@name='version']")
+                                ))
+
+                        # Discard processed entities to keep memory usage bounded.
+                        entity.clear()
+                        while entity.getprevious() is not None:
+                            del entity.getparent()[0]
+                except xml.XMLSyntaxError as syntax_error:
+                    problems.append("entities.xml is not well-formed: {}".format(syntax_error))
+    except zipfile.BadZipFile as bad_zip_file:
+        problems.append("Bundle is not a valid zip file: {}".format(bad_zip_file))
+
+        return problems
+    except OSError as os_error:
+        problems.append("Unable to read bundle: {}".format(os_error))
+
+        return problems
+
+    for entity_id, reference_class, reference_id in references:
+        if entity_classes.get(reference_id) != reference_class:
+            problems.append("Entity {} refers to missing {} {}.".format(entity_id, reference_class, reference_id))
+
+    if "Space" in entity_classes.values() and not space_administered:
+        problems.append("Space has no administrators (no SETSPACEPERMISSIONS space permission).")
+
+    for page_id, parent_id in page_parents.items():
+        if (parent_id, page_id) not in page_children:
+            problems.append("Page {} is not one of the children of its parent page {}.".format(page_id, parent_id))
+    for parent_id, page_id in page_children:
+        if page_parents.get(page_id) != parent_id:
+            problems.append("Page {} lists page {} as a child, but is not its parent.".format(parent_id, page_id))
+
+    for page_id in page_ids:
+        if page_id not in docfx_property_pages:
+            problems.append("Page {} has no docfx content property.".format(page_id))
+
+    for page_id, target_title in page_links:
+        if (target_title or "").lower() not in page_titles:
+            problems.append("Page {} links to missing page '{}'.".format(page_id, target_title))
+
+    for attachment_name in attachment_data:
+        if attachment_name not in bundle_names:
+            problems.append("Bundle does not contain data for attachment '{}'.".format(attachment_name))
+
+    for page_id, attachment_filename in attachment_links:
+        if (page_id, attachment_filename) not in attachment_titles:
+            problems.append("Page {} refers to missing attachment '{}'.".format(page_id, attachment_filename))
+
+    return problems
+
+
+def parse_storage_format(body):
+    """
+    Parse a page body in Confluence storage format (XHTML, with "ac" and "ri" namespace prefixes).
+
+    :param body: The page body.
+    :returns: An element containing the parsed body.
+    :raises lxml.etree.XMLSyntaxError: The body is not well-formed.
+    """
+
+    namespace_declarations = " ".join(
+        'xmlns:{}="{}"'.format(prefix, namespace) for prefix, namespace in sorted(STORAGE_FORMAT_NAMESPACES.items())
+    )
+    parser = xml.XMLParser(huge_tree=True, resolve_entities=False)
+
+    return xml.fromstring("<body {}>{}</body>".format(namespace_declarations, body), parser)
+
+
+def read_entity_id(element):
+    """
+    Read the Id of an entity (or entity reference) in a Confluence export bundle.
+
+    :param element: The entity (or entity reference) element.
+    :returns: The Id, or None if the element is missing or does not have a valid Id.
+    :rtype: str
+    """
+
+    if element is None:
+        return None
+
+    id_element = element.find("id")
+    if id_element is None or not id_element.text:
+        return None
+
+    if id_element.attrib.get("name") == "id" and not id_element.text.isdigit():
+        return None
+
+    return id_element.text
 
 
 def load_docfx_manifest(filename):
@@ -281,7 +1075,35 @@ def load_docfx_xref_map(filename):
     """
 
     with open(filename) as xref_map_file:
-        return yaml.load(xref_map_file)["references"]
+        return yaml.safe_load(xref_map_file)["references"]
+
+
+def load_page_content(base_directory, page_href):
+    """
+    Load the content of a page from the generated DocFX web site.
+
+    :param base_directory: The local file-system path of the generated DocFX web site.
+    :param page_href: The page's URL in the generated DocFX web site.
+    :returns: A tuple containing the page's directory (relative to root) and the page content.
+
+    :type base_directory: str
+    :type page_href: str
+    :rtype: tuple
+    """
+
+    _, _, page_path, _, _ = urlparse.urlsplit(page_href)
+    page_path = urlparse.unquote(page_path)
+
+    page_dir = os.path.dirname(page_path.lstrip("/"))
+    page_local_path = os.path.join(base_directory,
+        *page_path.lstrip("/").split("/")
+    )
+    with open(page_local_path) as page_content_file:
+        page_content = '\n'.join((
+            line.lstrip("\xef\xbb\xbf") for line in page_content_file.readlines()
+        ))
+
+    return page_dir, page_content
 
 
 def parse_args():
@@ -296,11 +1118,9 @@ def parse_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("--docfx-manifest",
-        required=True,
         help="The local file-system path of manifest.json in the generated DocFX web site."
     )
     parser.add_argument("--confluence-space",
-        required=True,
         help="The key (short name) of the target space in Confluence."
     )
     parser.add_argument("--confluence-address",
@@ -315,8 +1135,61 @@ def parse_args():
         default=os.getenv("CONFLUENCE_PASSWORD"),
         help="The password for authentication to Confluence."
     )
+    parser.add_argument("--export-bundle",
+        help="Instead of publishing to Confluence, write a space export bundle (zip file) to this local file-system path."
+    )
+    parser.add_argument("--export-first-id",
+        type=int,
+        default=100000000,
+        help="The first Id to assign to entities in the space export bundle (must not clash with existing Confluence content)."
+    )
+    parser.add_argument("--confluence-build-number",
+        help="The build number of the target Confluence server, as shown under General Configuration > System Information "
+             "(required with --export-bundle; the bundle is recorded as created by this build, so only import it into that build)."
+    )
+    parser.add_argument("--export-creator-key",
+        help="The user key of the Confluence user (named by --confluence-user) to record as the creator of exported content "
+             "(from /rest/api/user?username=...). If not specified, exported content has no creator."
+    )
+    parser.add_argument("--export-admin-group",
+        default="confluence-administrators",
+        help="The Confluence group whose members administer the space created from the space export bundle."
+    )
+    parser.add_argument("--export-view-group",
+        default="confluence-users",
+        help="The Confluence group whose members can view the space created from the space export bundle."
+    )
+    parser.add_argument("--verify-bundle",
+        help="Instead of publishing to Confluence, verify the space export bundle (zip file) at this local file-system path."
+    )
     args = parser.parse_args()
 
+    if args.verify_bundle:
+        return args
+
+    if not args.docfx_manifest:
+        parser.exit(status=1,
+            message="Must specify local file-system path of DocFX manifest using --docfx-manifest argument."
+        )
+
+    if not args.confluence_space:
+        parser.exit(status=1,
+            message="Must specify key of target Confluence space using --confluence-space argument."
+        )
+
+    if args.export_bundle:
+        if not args.confluence_build_number:
+            parser.exit(status=1,
+                message="Must specify build number of target Confluence server using --confluence-build-number argument."
+            )
+
+        if args.export_creator_key and not args.confluence_user:
+            parser.exit(status=1,
+                message="Must specify user name of content creator using --confluence-user argument or CONFLUENCE_USER environment variable."
+            )
+
+        return args
+
     if not args.confluence_address:
         parser.exit(status=1,
             message="Must specify address of Confluence server using --confluence-address argument or CONFLUENCE_ADDR environment variable."
@@ -403,17 +1276,7 @@ class ConfluenceClient(object):
         page_id = response["id"]
 
         # Attach DocFX metadata.
-        property_url = "content/{}/property".format(page_id)
-        response = self.post_json(property_url, data={
-            "key": "docfx",
-            "value": {
-                "description": "DocFX page properties",
-                "content": {
-                    "docfx_uid": docfx_uid,
-                    "docfx_href": docfx_href
-                }
-            }
-        })
+        self.create_docfx_property(page_id, docfx_uid, docfx_href)
 
         return page_id
 
@@ -474,8 +1337,25 @@ class ConfluenceClient(object):
         if "message" in response:
             raise Exception(response["message"])
 
+        self.create_docfx_property(page_id, docfx_uid, docfx_href)
+
+        return page_id
+
+    def create_docfx_property(self, page_id, docfx_uid, docfx_href):
+        """
+        Attach DocFX metadata to a page in Confluence.
+
+        :param page_id: The Id of the target page in Confluence.
+        :param docfx_uid: The page's associated DocFX UID.
+        :param docfx_href: The page's URL in the generated DocFX web site.
+
+        :type page_id: int
+        :type docfx_uid: str
+        :type docfx_href: str
+        """
+
         property_url = "content/{}/property".format(page_id)
-        self.post_json(property_url, data={
+        response = self.post_json(property_url, data={
             "key": "docfx",
             "value": {
                 "description": "DocFX page properties",
@@ -486,7 +1366,8 @@ class ConfluenceClient(object):
             }
         })
 
-        return page_id
+        if "id" not in response:
+            raise Exception(response["message"])
 
     def get_json(self, relative_url, **kwargs):
         """
@@ -0,0 +1,387 @@
+"""
+Tests for the space export bundle support in scripts/publish_docfx_to_confluence.py.
+"""
+
+import importlib.util
+import json
+import lxml.etree as xml
+import lxml.html as html
+import os
+import pytest
+import zipfile
+
+SCRIPT_PATH = os.path.join(os.path.dirname(__file__), "..", "scripts", "publish_docfx_to_confluence.py")
+SITE_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures", "site")
+
+_spec = importlib.util.spec_from_file_location("publish_docfx_to_confluence", SCRIPT_PATH)
+publish = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(publish)
+
+
+@pytest.fixture
+def bundle_filename(tmp_path):
+    """
+    Export the fixture site to a space export bundle.
+    """
+
+    filename = str(tmp_path / "site.zip")
+    docfx_mappings = publish.load_docfx_xref_map(os.path.join(SITE_DIRECTORY, "xrefmap.yml"))
+    publish.export_bundle(filename, "DOC", SITE_DIRECTORY, docfx_mappings,
+        first_id=1000,
+        build_number="1234",
+        creator=("admin", "8a7f808a5a1b1c2d")
+    )
+
+    return filename
+
+
+def read_pages(bundle_filename):
+    """
+    Read the pages in a space export bundle.
+
+    :returns: A dictionary mapping page title to a dictionary (id, parent_id, body, attachments).
+    """
+
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        entities = xml.fromstring(bundle.read("entities.xml"))
+
+    pages = {}
+    pages_by_id = {}
+    for entity in entities.iterfind("object[@class='Page']"):
+        page = {
+            "id": entity.findtext("id"),
+            "parent_id": entity.findtext("property[@name='parent']/id"),
+            "ancestor_ids": [element.findtext("id") for element in entity.iterfind("collection[@name='ancestors']/element")],
+            "child_ids": [element.findtext("id") for element in entity.iterfind("collection[@name='children']/element")],
+            "attachments": {}
+        }
+        pages[entity.findtext("property[@name='title']")] = page
+        pages_by_id[page["id"]] = page
+
+    for entity in entities.iterfind("object[@class='BodyContent']"):
+        page = pages_by_id.get(entity.findtext("property[@name='content']/id"))
+        if page is not None:
+            page["body"] = html.fragment_fromstring(entity.findtext("property[@name='body']"), create_parent="div")
+
+    for entity in entities.iterfind("object[@class='Attachment']"):
+        page = pages_by_id[entity.findtext("property[@name='containerContent']/id")]
+        page["attachments"][entity.findtext("property[@name='title']")] = entity.findtext("id")
+
+    return pages
+
+
+def get_page_links(body):
+    return [
+        (page_link.attrib["ri:content-title"], page_link.getparent().attrib.get("ac:anchor"))
+        for page_link in body.iter("ri:page")
+    ]
+
+
+def test_export_bundle_verifies(bundle_filename):
+    assert publish.find_bundle_problems(bundle_filename) == []
+
+    publish.verify_bundle(bundle_filename)
+
+
+def test_export_bundle_bodies_are_xhtml(bundle_filename):
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        entities = xml.fromstring(bundle.read("entities.xml"))
+
+    bodies = [entity.findtext("property[@name='body']") for entity in entities.iterfind("object[@class='BodyContent']")]
+    assert bodies
+    for body in bodies:
+        body_xml = xml.fromstring(
+            '<body xmlns:ac="http://atlassian.com/content" xmlns:ri="http://atlassian.com/resource/identifier">'
+            + body + "</body>"
+        )
+        assert body_xml is not None
+
+    greeting = next(body for body in bodies if "<h1>Greeting</h1>" in body)
+    assert "<br/>" in greeting
+    assert "<hr/>" in greeting
+    assert '<ac:plain-text-body><![CDATA[Console.WriteLine("Hello");]]></ac:plain-text-body>' in greeting
+
+
+def test_export_bundle_links_pages_by_title(bundle_filename):
+    pages = read_pages(bundle_filename)
+
+    assert get_page_links(pages["DocFX - Home (index)"]["body"]) == [
+        ("DocFX - Foo (Simple.Foo)", None),
+        ("DocFX - Introduction (intro)", "getting-started")
+    ]
+    assert get_page_links(pages["DocFX - Foo (Simple.Foo)"]["body"]) == [
+        ("DocFX - Home (index)", None)
+    ]
+    assert get_page_links(pages["DocFX - Introduction (intro)"]["body"]) == [
+        ("DocFX - Foo (Simple.Foo)", None)
+    ]
+
+    # Page hrefs are URL-encoded in the xrefmap.
+    assert get_page_links(pages["DocFX - Greeting (greeting)"]["body"]) == [
+        ("DocFX - Introduction (intro)", None),
+        ("DocFX - Hello World (hello)", None)
+    ]
+    assert get_page_links(pages["DocFX - Hello World (hello)"]["body"]) == [
+        ("DocFX - Greeting (greeting)", None)
+    ]
+
+    link_body = next(pages["DocFX - Greeting (greeting)"]["body"].iter("ac:link-body"))
+    assert html.tostring(link_body) == b"<ac:link-body><code>intro</code> article</ac:link-body>"
+
+    # External xref links are left alone.
+    external_links = pages["DocFX - Foo (Simple.Foo)"]["body"].cssselect("a.xref")
+    assert [anchor.attrib["href"] for anchor in external_links] == [
+        "https://docs.microsoft.com/dotnet/api/system.object"
+    ]
+
+
+def test_export_bundle_preserves_hierarchy(bundle_filename):
+    pages = read_pages(bundle_filename)
+
+    home_id = pages["DocFX - Home (index)"]["id"]
+    api_id = pages["DocFX - API (api)"]["id"]
+
+    assert pages["DocFX - Home (index)"]["parent_id"] is None
+    assert pages["DocFX - API (api)"]["parent_id"] == home_id
+    assert pages["DocFX - Foo (Simple.Foo)"]["parent_id"] == api_id
+    assert pages["DocFX - Introduction (intro)"]["parent_id"] == home_id
+    assert pages["DocFX - Greeting (greeting)"]["parent_id"] == home_id
+    assert pages["DocFX - Hello World (hello)"]["parent_id"] == home_id
+
+    foo_id = pages["DocFX - Foo (Simple.Foo)"]["id"]
+    assert pages["DocFX - Foo (Simple.Foo)"]["ancestor_ids"] == [home_id, api_id]
+    assert pages["DocFX - API (api)"]["child_ids"] == [foo_id]
+    assert sorted(pages["DocFX - Home (index)"]["child_ids"]) == sorted(
+        page["id"] for page in pages.values() if page["parent_id"] == home_id
+    )
+    assert pages["DocFX - Foo (Simple.Foo)"]["child_ids"] == []
+
+
+def test_export_bundle_space_permissions(bundle_filename):
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        entities = xml.fromstring(bundle.read("entities.xml"))
+
+    space = entities.find("object[@class='Space']")
+    permission_ids = [element.findtext("id") for element in space.iterfind("collection[@name='permissions']/element")]
+
+    permissions = set()
+    for permission in entities.iterfind("object[@class='SpacePermission']"):
+        assert permission.findtext("id") in permission_ids
+        assert permission.findtext("property[@name='space']/id") == space.findtext("id")
+        permissions.add((
+            permission.findtext("property[@name='type']"),
+            permission.findtext("property[@name='group']"),
+            permission.findtext("property[@name='userSubject']/id")
+        ))
+
+    assert len(permissions) == len(permission_ids)
+    assert ("SETSPACEPERMISSIONS", "confluence-administrators", None) in permissions
+    assert ("SETSPACEPERMISSIONS", None, "8a7f808a5a1b1c2d") in permissions
+    assert ("VIEWSPACE", "confluence-users", None) in permissions
+    assert ("EDITSPACE", "confluence-users", None) not in permissions
+
+
+def test_export_bundle_attaches_local_images(bundle_filename):
+    pages = read_pages(bundle_filename)
+    intro = pages["DocFX - Introduction (intro)"]
+
+    # Images with the same file name are given unique attachment names; repeated images are only attached once.
+    assert sorted(intro["attachments"]) == ["logo-2.png", "logo.png"]
+    assert [
+        attachment.attrib["ri:filename"] for attachment in intro["body"].iter("ri:attachment")
+    ] == ["logo.png", "logo-2.png", "logo.png"]
+
+    # Missing and out-of-site images are not attached; remote images are referenced by URL.
+    assert [image.attrib["src"] for image in intro["body"].iter("img")] == [
+        "missing.png", "../../../etc/outside.png", "#"
+    ]
+    assert [url.attrib["ri:value"] for url in intro["body"].iter("ri:url")] == ["https://example.com/remote.png"]
+
+    attachment_names = []
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        for attachment_filename, image_path in (("logo.png", "images/logo.png"), ("logo-2.png", "articles/images/logo.png")):
+            attachment_name = "attachments/{}/{}/1".format(intro["id"], intro["attachments"][attachment_filename])
+            with open(os.path.join(SITE_DIRECTORY, *image_path.split("/")), "rb") as image_file:
+                assert bundle.read(attachment_name) == image_file.read()
+
+            attachment_names.append(attachment_name)
+
+        assert sorted(bundle.namelist()) == sorted([
+            "entities.xml", "exportDescriptor.properties"
+        ] + attachment_names)
+
+
+def test_export_bundle_docfx_properties(bundle_filename):
+    pages = read_pages(bundle_filename)
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        entities = xml.fromstring(bundle.read("entities.xml"))
+
+    docfx_properties = {}
+    for entity in entities.iterfind("object[@class='CustomContentEntityObject']"):
+        assert entity.findtext("property[@name='pluginModuleKey']") == publish.CONTENT_PROPERTY_MODULE_KEY
+        assert entity.findtext("property[@name='title']") == "docfx"
+
+        body_id = entity.findtext("collection[@name='bodyContents']/element/id")
+        body = entities.find("object[@class='BodyContent'][id='{}']".format(body_id))
+        docfx_properties[entity.findtext("property[@name='containerContent']/id")] = json.loads(
+            body.findtext("property[@name='body']")
+        )
+
+    assert docfx_properties[pages["DocFX - Foo (Simple.Foo)"]["id"]] == {
+        "description": "DocFX page properties",
+        "content": {
+            "docfx_uid": "Simple.Foo",
+            "docfx_href": "api/Foo.html"
+        }
+    }
+    assert sorted(docfx_properties) == sorted(page["id"] for page in pages.values())
+
+
+def test_export_bundle_descriptor(bundle_filename):
+    with zipfile.ZipFile(bundle_filename) as bundle:
+        export_descriptor = bundle.read("exportDescriptor.properties").decode("utf-8").splitlines()
+
+    assert "exportType=space" in export_descriptor
+    assert "spaceKey=DOC" in export_descriptor
+    assert "buildNumber=1234" in export_descriptor
+    assert "createdByBuildNumber=1234" in export_descriptor
+
+
+def write_bundle(filename, entities):
+    with zipfile.ZipFile(filename, "w") as bundle:
+        bundle.writestr("entities.xml", entities)
+        bundle.writestr("exportDescriptor.properties", "exportType=space\nspaceKey=DOC\nbuildNumber=1234\n")
+
+
+def test_verify_bundle_reports_malformed_entities(tmp_path):
+    filename = str(tmp_path / "bad.zip")
+    write_bundle(filename, """<hibernate-generic>
+        <object class="Page" package="com.atlassian.confluence.pages"></object>
+        <object class="Page" package="com.atlassian.confluence.pages"><id name="id">abc</id></object>
+        <object class="BodyContent" package="com.atlassian.confluence.core"><id name="id">2</id></object>
+    </hibernate-generic>""")
+
+    assert publish.find_bundle_problems(filename) == [
+        "Page entity has a missing or invalid Id.",
+        "Page entity has a missing or invalid Id.",
+        "BodyContent 2 does not belong to any content."
+    ]
+
+
+def test_verify_bundle_reports_dangling_links(tmp_path):
+    filename = str(tmp_path / "dangling.zip")
+    body = (
+        '<p><a class="xref" href="../api/Foo.html">Foo</a>'
+        '<ac:link><ri:page ri:content-title="Missing"></ri:page></ac:link>'
+        '<ac:image><ri:attachment ri:filename="missing.png"></ri:attachment></ac:image></p>'
+    )
+    page = xml.Element("object", {"class": "Page", "package": "com.atlassian.confluence.pages"})
+    xml.SubElement(page, "id", name="id").text = "1"
+    xml.SubElement(page, "property", name="title").text = "Page"
+    body_content = xml.Element("object", {"class": "BodyContent", "package": "com.atlassian.confluence.core"})
+    xml.SubElement(body_content, "id", name="id").text = "2"
+    xml.SubElement(body_content, "property", name="body").text = body
+    content = xml.SubElement(body_content, "property", {
+        "name": "content", "class": "Page", "package": "com.atlassian.confluence.pages"
+    })
+    xml.SubElement(content, "id", name="id").text = "1"
+    write_bundle(filename, b"<hibernate-generic>" + xml.tostring(page) + xml.tostring(body_content) + b"</hibernate-generic>")
+
+    assert publish.find_bundle_problems(filename) == [
+        "Page 1 has unresolved xref link '../api/Foo.html'.",
+        "Page 1 has no docfx content property.",
+        "Page 1 links to missing page 'Missing'.",
+        "Page 1 refers to missing attachment 'missing.png'."
+    ]
+
+
+def test_verify_bundle_reports_malformed_body(tmp_path):
+    filename = str(tmp_path / "html-body.zip")
+    write_bundle(filename, """<hibernate-generic>
+        <object class="Page" package="com.atlassian.confluence.pages"><id name="id">1</id><property name="title">Page</property></object>
+        <object class="BodyContent" package="com.atlassian.confluence.core"><id name="id">2</id>
+            <property name="body">&lt;p&gt;Image: &lt;img src="x.png"&gt;&lt;/p&gt;</property>
+            <property name="content" class="Page" package="com.atlassian.confluence.pages"><id name="id">1</id></property>
+        </object>
+    </hibernate-generic>""")
+
+    problems = publish.find_bundle_problems(filename)
+    assert len(problems) == 2
+    assert problems[0].startswith("Body of page 1 is not well-formed storage format: ")
+    assert problems[1] == "Page 1 has no docfx content property."
+
+
+def test_verify_bundle_reports_inconsistent_hierarchy(tmp_path):
+    filename = str(tmp_path / "hierarchy.zip")
+    write_bundle(filename, """<hibernate-generic>
+        <object class="Space" package="com.atlassian.confluence.spaces"><id name="id">1</id></object>
+        <object class="Page" package="com.atlassian.confluence.pages"><id name="id">2</id><property name="title">Parent</property></object>
+        <object class="Page" package="com.atlassian.confluence.pages"><id name="id">3</id><property name="title">Child</property>
+            <property name="parent" class="Page" package="com.atlassian.confluence.pages"><id name="id">2</id></property>
+        </object>
+    </hibernate-generic>""")
+
+    problems = publish.find_bundle_problems(filename)
+    assert "Space has no administrators (no SETSPACEPERMISSIONS space permission)." in problems
+    assert "Page 3 is not one of the children of its parent page 2." in problems
+
+
+def test_verify_bundle_reports_invalid_zip(tmp_path):
+    filename = tmp_path / "not-a-bundle.zip"
+    filename.write_text("This is not a zip file.")
+
+    assert publish.find_bundle_problems(str(filename)) == ["Bundle is not a valid zip file: File is not a zip file"]
+
+    with pytest.raises(Exception):
+        publish.verify_bundle(str(filename))
+
+
+def test_verify_bundle_reports_missing_file(tmp_path):
+    filename = str(tmp_path / "missing.zip")
+
+    problems = publish.find_bundle_problems(filename)
+    assert len(problems) == 1
+    assert problems[0].startswith("Unable to read bundle: ")
+
+
+@pytest.mark.parametrize("base_dir, path, expected", [
+    ("", "api/Foo.html", "api/Foo.html"),
+    ("articles", "../api/Foo.html", "api/Foo.html"),
+    ("articles", "/api/Foo.html", "api/Foo.html"),
+    ("articles", "images/a%20b.png", "articles/images/a b.png"),
+    ("api", "../../../etc/x.png", None),
+    ("api", "", None),
+    ("api", "images/", None)
+])
+def test_resolve_site_path(base_dir, path, expected):
+    assert publish.resolve_site_path(base_dir, path) == expected
+
+
+class StubConfluenceClient(object):
+    """
+    Stub Confluence client that serves a single page of results.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_json(self, relative_url, **kwargs):
+        if "start=0&" in relative_url:
+            return {"page": {"size": len(self.pages), "results": self.pages}}
+
+        return {"page": {"size": 0, "results": []}}
+
+
+def test_get_confluence_mappings_reports_untracked_pages():
+    confluence_client = StubConfluenceClient([
+        {"id": "11", "title": "DocFX - Home (index)", "metadata": {"properties": {}}},
+        {"id": "12", "title": "DocFX - API (api)", "metadata": {"properties": {"docfx": {"value": {"content": {
+            "docfx_uid": "api", "docfx_href": "api/index.html"
+        }}}}}}
+    ])
+
+    untracked_pages = {}
+    mappings = publish.get_confluence_mappings(confluence_client, "DOC", untracked_pages)
+
+    assert mappings == [{"confluence_id": "12", "docfx_uid": "api", "docfx_href": "api/index.html"}]
+    assert untracked_pages == {"DocFX - Home (index)": "11"}